@@ -1,11 +1,13 @@
 import argparse
-import os
+import hashlib
 from pathlib import Path
 from typing import Any
+import orjson
 import structlog
 from immich_client import ImmichClient
 
 DEVICE_ID = 'Library Import'
+CACHE_DIR = Path.home() / '.cache' / 'immich_utils'
 
 logger = structlog.get_logger()
 
@@ -16,6 +18,7 @@ class ImmichAbumCreator:
         server_url: str, 
         api_key: str, 
         path: str,
+        use_cache: bool = True,
     ) -> None:
         """
         Initialize the Immich album creator.
@@ -24,56 +27,79 @@ class ImmichAbumCreator:
             server_url: Base URL of the Immich server (e.g., 'https://immich.example.com')
             api_key: API key with full access
             path: External library path
+            use_cache: If False, ignore the cache from previous runs and fetch everything
         """
         self.client = ImmichClient(server_url, api_key)
         self.path = path
 
+        server_key = hashlib.sha1(self.client.server_url.encode('utf-8')).hexdigest()[:16]
+        self.cache_file = CACHE_DIR / f'album_creator_{server_key}.json'
+        self.cache = self.load_cache() if use_cache else {}
+
+
+    def load_cache(self) -> dict[str, Any]:
+        """Load assets and albums cached by a previous run."""
+        if not self.cache_file.exists():
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                return orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError) as e:
+            logger.warning(f'Ignoring unreadable cache {self.cache_file}: {e}')
+            return {}
+
+
+    def save_cache(self) -> None:
+        """Save assets and albums so the next run only fetches what changed."""
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_file, 'wb') as f:
+            f.write(orjson.dumps(self.cache))
+
 
     def fetch_all_assets(self) -> list[dict[str, Any]]:
         """
         Fetch all assets from the Immich server using pagination.
         Filter assets with deviceId 'Library Import'.
+        Only assets updated since the previous run are fetched, the rest come from the cache.
         """
         logger.info('Fetching assets from Immich server...')
         
-        all_assets = []
-        page = 1
-        size = 100  # Fetch 100 assets per page for efficiency
-
-        while True:
-            logger.debug(f'Fetching page {page}...')
-            
-            payload = {
-                'size': size,
-                'page': page
-            }
-            
-            data = self.client.fetch_assets_info(payload)
-
-            if not data:
-                logger.error('No data returned from Immich server')
-                break
-                
-            assets = data.get('assets', {}).get('items', [])
-            
-            if not assets:
-                logger.error('No assets returned from Immich server')
-                break
-            
-            # Filter assets for external library
-            filtered_assets = [
-                asset for asset in assets 
-                if asset.get('deviceId') == DEVICE_ID
-            ]
-
-            all_assets.extend(filtered_assets)
-            logger.debug(f'Found {len(all_assets)} assets so far')
-            
-            # Check if there's a next page
-            if not data.get('assets', {}).get('nextPage'):
-                logger.info('All pages fetched')
-                break
-            page += 1
+        search = {
+            'deviceId': DEVICE_ID  # Only assets of the external library
+        }
+        payload = {
+            **search,
+            'size': 100  # Fetch 100 assets per page for efficiency
+        }
+        cursor = self.cache.get('cursor')
+        if cursor:
+            logger.info(f'Fetching assets updated after {cursor}')
+            payload['updatedAfter'] = cursor
+
+        all_assets, complete = self.client.fetch_all_assets(payload)
+
+        # Merge updated assets into the cached ones
+        assets_by_id = {asset['id']: asset for asset in self.cache.get('assets', [])}
+        assets_by_id.update((asset['id'], asset) for asset in all_assets)
+
+        if cursor:
+            # Assets trashed since the previous run are not in the updatedAfter results
+            trashed_assets, trashed_complete = self.client.fetch_all_assets(
+                {**search, 'size': 100, 'trashedAfter': cursor, 'withDeleted': True}
+            )
+            for asset in trashed_assets:
+                assets_by_id.pop(asset['id'], None)
+            # Anything else missing, e.g. permanently deleted assets, shows up as a count mismatch
+            if not trashed_complete or self.client.count_assets(search) != len(assets_by_id):
+                logger.info('Cached assets are out of sync with the server, fetching all assets')
+                self.cache.pop('cursor', None)
+                self.cache['assets'] = []
+                return self.fetch_all_assets()
+        # Only move the cursor forward if no page was missed
+        if complete and all_assets:
+            self.cache['cursor'] = max(asset['updatedAt'] for asset in all_assets)
+        all_assets = list(assets_by_id.values())
+        self.cache['assets'] = all_assets
             
         logger.info(f'Total assets: {len(all_assets)}')
         return all_assets
@@ -87,7 +113,10 @@ class ImmichAbumCreator:
 
         assets = self.fetch_all_assets()
 
-        album_tree, album_id_mapping = self.client.fetch_album_tree()
+        album_tree, album_id_mapping = self.client.fetch_album_tree(self.cache.setdefault('albums', {}))
+
+        # Save before the asset paths are rewritten below
+        self.save_cache()
         
         if not assets:
             logger.info('No assets found to create album')
@@ -95,7 +124,8 @@ class ImmichAbumCreator:
 
         existing_album_new_assets = {}
         new_album_assets = {}
-        prefix_to_remove = Path(self.path)
+        prefix_to_remove = str(Path(self.path)).rstrip('/') + '/'
+        prefix_len = len(prefix_to_remove)
 
         if only_new:
             all_assets_in_albums = set().union(*album_tree.values())
@@ -103,17 +133,17 @@ class ImmichAbumCreator:
             logger.info(f'Found {len(assets)} new assets')
 
         for asset in assets:
-            asset['originalPath'] = str(Path(asset['originalPath']).relative_to(prefix_to_remove))
-            album_name = os.path.split(asset['originalPath'])[0].replace('/', ' ')
-            if album_name in album_tree:
-                if asset['id'] not in album_tree[album_name]:
-                    if album_id_mapping[album_name] not in existing_album_new_assets:
-                        existing_album_new_assets[album_id_mapping[album_name]] = []
-                    existing_album_new_assets[album_id_mapping[album_name]].append(asset['id'])
+            if not asset['originalPath'].startswith(prefix_to_remove):
+                logger.warning(f'Skipping {asset["originalPath"]}, not in the subpath of {prefix_to_remove}')
+                continue
+            asset['originalPath'] = asset['originalPath'][prefix_len:]
+            album_name = asset['originalPath'].rpartition('/')[0].replace('/', ' ')
+            album_assets = album_tree.get(album_name)
+            if album_assets is not None:
+                if asset['id'] not in album_assets:
+                    existing_album_new_assets.setdefault(album_id_mapping[album_name], []).append(asset['id'])
             else:
-                if album_name not in new_album_assets:
-                    new_album_assets[album_name] = []
-                new_album_assets[album_name].append(asset['id'])
+                new_album_assets.setdefault(album_name, []).append(asset['id'])
 
         for album_name, album_assets in new_album_assets.items():
             logger.info(f'Creating album {album_name} with {len(album_assets)} assets')
@@ -133,7 +163,7 @@ class ImmichAbumCreator:
 
 
 def main(args: argparse.Namespace) -> None:
-    creator = ImmichAbumCreator(args.server_url, args.api_key, args.path)
+    creator = ImmichAbumCreator(args.server_url, args.api_key, args.path, use_cache=not args.no_cache)
     creator.run()
     
 
@@ -142,6 +172,8 @@ if __name__ == '__main__':
     parser.add_argument('server_url', help='Immich server URL (e.g., https://immich.example.com)')
     parser.add_argument('api_key', help='API key with full access')
     parser.add_argument('path', help='Extrnal libray path')
+    parser.add_argument('--no-cache', action='store_true',
+            help='Ignore the cache from previous runs and fetch all assets and albums')
 
     
     args = parser.parse_args()
@@ -1,36 +1,83 @@
 import argparse
-import json
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import threading
+import time
+import orjson
 import structlog
-from immich_client import ImmichClient
+from tqdm import tqdm
+from immich_client import ImmichClient, positive_int
 
 
 logger = structlog.get_logger()
 
 
-def chunk_list_for_loop(data_list: list[str], chunk_size: int) -> list[list[str]]:
-    result_chunks = []
-    for i in range(0, len(data_list), chunk_size):
-        result_chunks.append(data_list[i:i + chunk_size])
-    return result_chunks
+class RateLimiter:
+    def __init__(self, rate: float) -> None:
+        """
+        Limit the number of calls per second across threads.
+        
+        Args:
+            rate: Maximum calls per second, 0 disables the limit
+        """
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def wait(self) -> None:
+        """Block until the next call is allowed."""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def chunked(data_list: list[str], chunk_size: int) -> Iterator[list[str]]:
+    return (data_list[i:i + chunk_size] for i in range(0, len(data_list), chunk_size))
 
 
 def main(args: argparse.Namespace) -> None:
-    client = ImmichClient(args.server_url, args.api_key)
+    client = ImmichClient(args.server_url, args.api_key, pool_size=args.delete_concurrency)
+    rate_limiter = RateLimiter(args.rate_limit)
 
-    with open(args.deletion_file) as f:
-        assets = json.load(f)
+    with open(args.deletion_file, 'rb') as f:
+        assets = orjson.loads(f.read())
 
     deletion_ids = [asset['id'] for asset in assets if asset['integrity'] == 'verified']
     logger.info(f'Found {len(deletion_ids)} assets to delete')
 
-    chunks = chunk_list_for_loop(deletion_ids, 100)
+    chunk_size = 100
+    n_chunks = -(-len(deletion_ids) // chunk_size)
+
+    def delete_chunk(chunk: list[str]) -> bool:
+        rate_limiter.wait()
+        return client.delete_assets(chunk)
+
+    results = []
+    failed_ids = 0
+    chunks = chunked(deletion_ids, chunk_size)
+    with ThreadPoolExecutor(max_workers=args.delete_concurrency) as executor, \
+            tqdm(total=n_chunks, unit='chunk', ncols=100, mininterval=0.25) as pbar:
+        # map submits its whole input at once, so hand it a bounded window of chunks at a time
+        while window := list(islice(chunks, args.delete_concurrency * 2)):
+            for chunk, deleted in zip(window, executor.map(delete_chunk, window)):
+                results.append(deleted)
+                if not deleted:
+                    failed_ids += len(chunk)
+                pbar.update(1)
 
-    for i, chunk in enumerate(chunks, 1):
-        logger.debug(f'Deleting chunk [{i}/{len(chunks)}]')
-        client.delete_assets(chunk)
+    failed_chunks = results.count(False)
+    if failed_chunks > 0:
+        logger.error(f'Failed to delete {failed_chunks} of {n_chunks} chunks')
 
-    logger.info(f'Deleted {len(deletion_ids)} assets from file {args.deletion_file}  with asset '
-                    f'length {len(assets)} deleted successfully')
+    logger.info(f'Deleted {len(deletion_ids) - failed_ids} of {len(deletion_ids)} assets from file '
+                    f'{args.deletion_file} with asset length {len(assets)}')
 
 
 if __name__ == '__main__':
@@ -39,6 +86,10 @@ if __name__ == '__main__':
     parser.add_argument('api_key', help='API key with full access')
     parser.add_argument('--deletion_file', default='downloads/downloaded_assets.json', 
             help='File with list of asset IDs to delete')
+    parser.add_argument('--delete-concurrency', type=positive_int, default=6,
+            help='Number of chunks deleted in parallel (default: 6)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+            help='Maximum delete requests per second, 0 for no limit (default: 0)')
     
     args = parser.parse_args()
 
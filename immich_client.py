@@ -1,109 +1,289 @@
+import argparse
+from collections import deque
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import os
 from pathlib import Path
-import time
+import struct
+import sys
 from typing import Any
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import structlog
-from tqdm import tqdm
+import urllib3
+from urllib3.util.retry import Retry
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 logger = structlog.get_logger()
 
+# Not exported by the fcntl module, value from <sys/fcntl.h>
+DARWIN_F_PREALLOCATE = 42
+
+
+def positive_int(value: str) -> int:
+    """argparse type for worker counts, which must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
 
 class ImmichClient:
-    def __init__(self, server_url: str, api_key: str) -> None:
+    def __init__(self, server_url: str, api_key: str, pool_size: int = 32) -> None:
         """
         Initialize the Immich Client.
         
         Args:
             server_url: Base URL of the Immich server (e.g., 'https://immich.example.com')
             api_key: API key with full access
+            pool_size: Number of connections to keep alive, should be at least
+                the number of threads sharing this client
         """
         self.server_url = server_url.rstrip('/')
         self.api_key = api_key
         
+        # Content-Type is set by requests for calls with a JSON body, and requests
+        # already advertises gzip so large search responses come back compressed
         self.headers = {
-            'x-api-key': api_key,
-            'Content-Type': 'application/json'
+            'x-api-key': api_key
         }
+
+        # Share one session so connections (and TLS handshakes) are reused across calls
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # Retry transient failures with exponential backoff, honouring Retry-After on 429.
+        # Connection and read errors get only a couple of retries, so an unreachable
+        # server fails fast instead of backing off for minutes
+        retry = Retry(
+            total=8,
+            connect=2,
+            read=2,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE'])
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size * 2,
+            max_retries=retry
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Creating an album is not idempotent, so never replay POSTs to the albums endpoints
+        albums_adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size * 2,
+            max_retries=retry.new(allowed_methods=retry.allowed_methods - {'POST'})
+        )
+        self.session.mount(f'{self.server_url}/api/albums', albums_adapter)
+        # A single attempt, so a wrong URL is reported at once
+        self.session.mount(f'{self.server_url}/api/server/about', HTTPAdapter(max_retries=0))
     
 
     def test_connection(self) -> bool:
         """Test connection to the Immich server."""
         try:
-            response = requests.get(f'{self.server_url}/api/server/about', headers=self.headers)
+            response = self.session.get(f'{self.server_url}/api/server/about')
             response.raise_for_status()
             return True
         except requests.exceptions.RequestException as e:
             return False
 
     
-    def fetch_assets_info(self, payload: dict[str, int]) -> list[dict[str, Any]] | None:
+    def fetch_assets_info(self, payload: dict[str, Any]) -> dict[str, Any] | None:
         """Fetch assets information from the Immich server."""
         try:
-            response = requests.post(
+            response = self.session.post(
                 f'{self.server_url}/api/search/metadata',
-                headers=self.headers,
                 json=payload
             )
             response.raise_for_status()
             
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logger.error(f'Error fetching page {payload["page"]}: {e}')
             return None
 
 
+    def count_assets(self, payload: dict[str, Any]) -> int | None:
+        """Count the assets matching a search payload on the Immich server."""
+        try:
+            response = self.session.post(
+                f'{self.server_url}/api/search/statistics',
+                json=payload
+            )
+            response.raise_for_status()
+            return orjson.loads(response.content)['total']
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError, KeyError) as e:
+            logger.error(f'Failed to count assets: {e}')
+            return None
+
+
+    def iter_assets_pages(
+        self,
+        payload: dict[str, Any],
+        prefetch: int = 4,
+    ) -> Iterator[dict[str, Any] | None]:
+        """
+        Yield pages of the metadata search in order, starting from page 1.
+
+        Up to `prefetch` page requests are kept in flight so that fetching the
+        next pages overlaps with processing the current one. The caller decides
+        when to stop (e.g. no `nextPage`); pending requests are then cancelled.
+
+        Args:
+            payload: Search payload without the page number
+            prefetch: Number of pages to request ahead
+        """
+        page = 1
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            try:
+                while True:
+                    while len(pending) < prefetch:
+                        pending.append(executor.submit(self.fetch_assets_info, {**payload, 'page': page}))
+                        page += 1
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+    def iter_assets(
+        self,
+        payload: dict[str, Any],
+        keep: Callable[[dict[str, Any]], bool] | None = None,
+        prefetch: int = 4,
+    ) -> Generator[Iterable[dict[str, Any]], None, bool]:
+        """
+        Yield the assets matching the search payload page by page, as soon as each page arrives.
+        
+        Args:
+            payload: Search payload without the page number
+            keep: Optional predicate selecting which assets to return, for filters
+                the search endpoint can't express
+            prefetch: Number of pages requested ahead of the one being processed
+            
+        Returns:
+            Whether every page was fetched
+        """
+        for page, data in enumerate(self.iter_assets_pages(payload, prefetch), 1):
+            logger.debug(f'Fetched page {page}')
+
+            if not data:
+                logger.error('No data returned from Immich server')
+                return False
+                
+            assets_block = data.get('assets') or {}
+            assets = assets_block.get('items', [])
+            
+            if not assets:
+                logger.info('No assets returned from Immich server')
+                return True
+            
+            # Filter lazily instead of building a filtered copy of each page
+            yield assets if keep is None else filter(keep, assets)
+            
+            # Check if there's a next page
+            if not assets_block.get('nextPage'):
+                logger.info('All pages fetched')
+                return True
+        return False
+
+
+    def fetch_all_assets(
+        self,
+        payload: dict[str, Any],
+        keep: Callable[[dict[str, Any]], bool] | None = None,
+        prefetch: int = 4,
+    ) -> tuple[list[dict[str, Any]], bool]:
+        """
+        Fetch all assets matching the search payload using pagination.
+        
+        Args:
+            payload: Search payload without the page number
+            keep: Optional predicate selecting which assets to return, for filters
+                the search endpoint can't express
+            prefetch: Number of pages requested ahead of the one being processed
+            
+        Returns:
+            The selected assets, and whether every page was fetched
+        """
+        all_assets = []
+        pages = self.iter_assets(payload, keep, prefetch)
+        while True:
+            try:
+                all_assets.extend(next(pages))
+            except StopIteration as stop:
+                return all_assets, stop.value
+            logger.debug(f'Found {len(all_assets)} assets so far')
+
+
+    @staticmethod
+    def preallocate(fd: int, size: int) -> None:
+        """Reserve disk space for a file of known size so it is written without fragmentation."""
+        if size <= 0:
+            return
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            elif sys.platform == 'darwin':
+                # fstore_t with F_ALLOCATEALL from the current end of file (F_PEOFPOSMODE)
+                fcntl.fcntl(fd, DARWIN_F_PREALLOCATE, struct.pack('Iiqqq', 0x4, 3, 0, size, 0))
+        except OSError as e:
+            # Not supported by every filesystem, the download works without it
+            logger.debug(f'Unable to preallocate {size} bytes: {e}')
+
+
     def download_asset(
         self, 
         asset_id: str, 
         filepath: Path, 
         original_filename: str,
+        hasher: Any = None,
     ) -> str:
+        """Download the original file of an asset.
+        
+        Args:
+            asset_id: ID of the asset
+            filepath: Where to save the file
+            original_filename: Name used for logging
+            hasher: Optional hashlib object updated with the file content as it is written
+        """
         try:
-            # Download the asset file content
-            response = requests.get(
+            # Download the asset file content, closing the response releases
+            # the connection back to the pool even if streaming fails
+            with self.session.get(
                 f'{self.server_url}/api/assets/{asset_id}/original',
-                headers=self.headers,
                 stream=True
-            )
-            response.raise_for_status()
-            
-            # Get total file size for progress tracking
-            total_size = int(response.headers.get('content-length', 0))
-            
-            # Save the file with progress tracking
-            with open(filepath, 'wb') as f:
-                downloaded = 0
-                start_time = time.time()
+            ) as response:
+                response.raise_for_status()
                 
-                # Create progress bar
-                with tqdm(
-                    total=total_size,
-                    unit='B',
-                    unit_scale=True,
-                    unit_divisor=1024,
-                    desc=f'{original_filename[:30]}{"..." if len(original_filename) > 30 else ""}',
-                    ncols=100,
-                    leave=False
-                ) as pbar:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            # Update progress bar
-                            pbar.update(len(chunk))
-                            
-                            # Calculate and display speed
-                            elapsed_time = time.time() - start_time
-                            if elapsed_time > 0:
-                                speed_mbps = (downloaded / (1024 * 1024)) / elapsed_time
-                                pbar.set_postfix(speed=f'{speed_mbps:.2f} MB/s')
+                # Stream the body straight to disk in 1 MiB blocks
+                response.raw.decode_content = True
+                total_size = int(response.headers.get('content-length', 0))
+                with open(filepath, 'wb') as f:
+                    self.preallocate(f.fileno(), total_size)
+                    while chunk := response.raw.read(1024 * 1024):
+                        # Hash while the bytes are in memory instead of reading the file back
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        f.write(chunk)
+                    downloaded = f.tell()
+                    # Drop any preallocated space the body didn't fill
+                    f.truncate()
             
             downloaded_mb = downloaded / (1024 * 1024)
-            logger.info(f'Downloaded: {original_filename} ({downloaded_mb:.2f} MB)')
+            logger.debug(f'Downloaded: {original_filename} ({downloaded_mb:.2f} MB)')
             return filepath.name
             
-        except requests.exceptions.RequestException as e:
+        # Reading response.raw directly surfaces urllib3 errors instead of requests ones
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
             logger.error(f'Failed to download {original_filename}: {e}')
             return ''
 
@@ -120,9 +300,8 @@ class ImmichClient:
                 'force': force,
                 'ids': asset_ids
             }
-            response = requests.delete(
+            response = self.session.delete(
                 f'{self.server_url}/api/assets',
-                headers=self.headers,
                 json=payload
             )
             response.raise_for_status()
@@ -146,9 +325,8 @@ class ImmichClient:
                 'albumName': album_name,
                 'assetIds': asset_ids
             }
-            response = requests.post(
+            response = self.session.post(
                 f'{self.server_url}/api/albums',
-                headers=self.headers,
                 json=payload
             )
             response.raise_for_status()
@@ -164,17 +342,16 @@ class ImmichClient:
             payload = {
                 'ids': asset_ids
             }
-            response = requests.put(
+            response = self.session.put(
                 f'{self.server_url}/api/albums/{album_id}/assets',
-                headers=self.headers,
                 json=payload
             )
             response.raise_for_status()
-            for resp in response.json():
+            for resp in orjson.loads(response.content):
                 if not resp.get('success', False):
                     logger.error(f'Failed to add {resp.get("id", "Unknown")} to album {album_id} reason: {resp.get("error", "Unknown")}')
             return True
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logger.error(f'Failed to add assets to album {album_id}: {e}')
             return False
 
@@ -182,37 +359,70 @@ class ImmichClient:
     def fetch_albums(self) -> list[str]:
         """Fetch all albums from the Immich server."""
         try:
-            response = requests.get(
-                f'{self.server_url}/api/albums',
-                headers=self.headers
+            response = self.session.get(
+                f'{self.server_url}/api/albums'
             )
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logger.error(f'Failed to fetch albums: {e}')
             return []
 
 
-    def fetch_album_tree(self) -> tuple[dict[str, list[str]], dict[str, str]]:
-        """Fetch album tree from the Immich server."""
+    def fetch_album(self, album_id: str) -> dict[str, Any]:
+        """Fetch a single album with its assets from the Immich server."""
+        response = self.session.get(
+            f'{self.server_url}/api/albums/{album_id}'
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+
+    def fetch_album_tree(
+        self,
+        album_cache: dict[str, dict[str, Any]] | None = None,
+        workers: int = 16,
+    ) -> tuple[dict[str, set[str]], dict[str, str]]:
+        """
+        Fetch album tree from the Immich server.
+        
+        Args:
+            album_cache: Album details keyed by album ID from a previous run. Albums whose
+                updatedAt and assetCount are unchanged are not fetched again. Updated in place.
+            workers: Number of albums fetched in parallel
+        """
+        if album_cache is None:
+            album_cache = {}
         try:
-            album_ids = [album['id'] for album in self.fetch_albums()]
+            albums = self.fetch_albums()
+            stale_albums = [
+                album for album in albums
+                if album['id'] not in album_cache
+                or album_cache[album['id']]['updatedAt'] != album.get('updatedAt')
+                or album_cache[album['id']]['assetCount'] != album.get('assetCount')
+            ]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                details = executor.map(self.fetch_album, [album['id'] for album in stale_albums])
+                for album, detail in zip(stale_albums, details):
+                    album_cache[album['id']] = {
+                        'updatedAt': album.get('updatedAt'),
+                        'assetCount': album.get('assetCount'),
+                        'assetIds': [asset['id'] for asset in detail['assets']]
+                    }
+
             album_tree = {}
             album_id_mapping = {}
-            for album_id in album_ids:
-                response = requests.get(
-                    f'{self.server_url}/api/albums/{album_id}',
-                    headers=self.headers
-                )
-                response.raise_for_status()
-                album = response.json()
-                album_tree[album['albumName']] = set([asset['id'] for asset in album['assets']])
+            for album in albums:
+                album_tree[album['albumName']] = set(album_cache[album['id']]['assetIds'])
                 # This is not a one to one mapping, there can be multiple albums with the same name
                 # But ideally because we are creating albums bases on the path of the assets,
                 # there should be only one album with the same name
                 # If there are multiple albums with the same name, which is seen last will be the one used
                 album_id_mapping[album['albumName']] = album['id']
+            # Forget albums which no longer exist on the server
+            for album_id in set(album_cache) - {album['id'] for album in albums}:
+                del album_cache[album_id]
             return album_tree, album_id_mapping
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logger.error(f'Failed to fetch albums: {e}')
             return {}, {}